@@ -0,0 +1,137 @@
+import sqlite3
+import threading
+from pathlib import Path
+
+# Identifiers from different columns share the union-find, so they are namespaced
+CKEY = "k:"
+CID = "c:"
+IP = "i:"
+
+# One graph links ckeys through computer ids and IPs, the other only through computer ids
+GRAPHS = ("full", "noip")
+
+
+class AltIndex:
+    """
+    Incrementally maintained union-find over the (ckey, computerid, ip) triples of a connection_log table
+
+    Everything is stored in a local SQLite file so the index survives restarts, and only rows past the stored
+    `watermark` are processed on each update. All methods are blocking and should be run in an executor.
+    """
+
+    def __init__(self, path: Path):
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+            for graph in GRAPHS:
+                self._conn.execute(
+                    f"CREATE TABLE IF NOT EXISTS {graph}_nodes (node TEXT PRIMARY KEY, parent TEXT NOT NULL, size INTEGER NOT NULL)"
+                )
+                self._conn.execute(f"CREATE TABLE IF NOT EXISTS {graph}_members (ckey TEXT PRIMARY KEY, root TEXT NOT NULL)")
+                self._conn.execute(f"CREATE INDEX IF NOT EXISTS {graph}_members_root ON {graph}_members (root)")
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _get_meta(self, key: str):
+        row = self._conn.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _set_meta(self, key: str, value):
+        self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+    def watermark(self) -> int:
+        """The highest connection_log id that has been indexed, 0 if nothing has been indexed yet"""
+        with self._lock:
+            return int(self._get_meta("watermark") or 0)
+
+    def is_built(self) -> bool:
+        """Whether the index has caught up with the connection_log table at least once"""
+        with self._lock:
+            return self._get_meta("built") is not None
+
+    def mark_built(self):
+        with self._lock, self._conn:
+            self._set_meta("built", 1)
+
+    def ensure_source(self, source: str):
+        """Clears the index if it was built from a different database than `source`"""
+        with self._lock, self._conn:
+            if self._get_meta("source") == source:
+                return
+            for graph in GRAPHS:
+                self._conn.execute(f"DELETE FROM {graph}_nodes")
+                self._conn.execute(f"DELETE FROM {graph}_members")
+            self._conn.execute("DELETE FROM meta")
+            self._set_meta("source", source)
+
+    def _find(self, graph: str, node: str) -> str:
+        path = []
+        while True:
+            row = self._conn.execute(f"SELECT parent FROM {graph}_nodes WHERE node=?", (node,)).fetchone()
+            if row is None:
+                self._conn.execute(f"INSERT INTO {graph}_nodes (node, parent, size) VALUES (?, ?, 1)", (node, node))
+                if node.startswith(CKEY):
+                    self._conn.execute(f"INSERT INTO {graph}_members (ckey, root) VALUES (?, ?)", (node[len(CKEY) :], node))
+                break
+            if row[0] == node:
+                break
+            path.append(node)
+            node = row[0]
+        # Path compression
+        for child in path:
+            self._conn.execute(f"UPDATE {graph}_nodes SET parent=? WHERE node=?", (node, child))
+        return node
+
+    def _union(self, graph: str, a: str, b: str):
+        root_a = self._find(graph, a)
+        root_b = self._find(graph, b)
+        if root_a == root_b:
+            return
+        size_a = self._conn.execute(f"SELECT size FROM {graph}_nodes WHERE node=?", (root_a,)).fetchone()[0]
+        size_b = self._conn.execute(f"SELECT size FROM {graph}_nodes WHERE node=?", (root_b,)).fetchone()[0]
+        if size_a < size_b:
+            root_a, root_b = root_b, root_a
+        # Union by size keeps both the trees and the member relabelling small
+        self._conn.execute(f"UPDATE {graph}_nodes SET parent=? WHERE node=?", (root_a, root_b))
+        self._conn.execute(f"UPDATE {graph}_nodes SET size=? WHERE node=?", (size_a + size_b, root_a))
+        self._conn.execute(f"UPDATE {graph}_members SET root=? WHERE root=?", (root_a, root_b))
+
+    def add_rows(self, rows: list):
+        """
+        Adds a batch of connection_log rows (dicts with id, ckey, computerid and ip) and advances the watermark
+
+        The batch is committed as a single transaction.
+        """
+        if not rows:
+            return
+        with self._lock, self._conn:
+            for row in rows:
+                ckey = CKEY + row["ckey"]
+                if row["computerid"] is not None:
+                    self._union("full", ckey, CID + str(row["computerid"]))
+                    self._union("noip", ckey, CID + str(row["computerid"]))
+                else:
+                    self._find("noip", ckey)
+                if row["ip"] is not None:
+                    self._union("full", ckey, IP + str(row["ip"]))
+                else:
+                    self._find("full", ckey)
+            self._set_meta("watermark", max(row["id"] for row in rows))
+
+    def component(self, ckey: str, check_ips: bool = True) -> "list | None":
+        """
+        Returns every ckey connected to `ckey`, excluding `ckey` itself
+
+        Returns None if the ckey has not been indexed.
+        """
+        graph = "full" if check_ips else "noip"
+        with self._lock:
+            row = self._conn.execute(f"SELECT root FROM {graph}_members WHERE ckey=?", (ckey,)).fetchone()
+            if row is None:
+                return None
+            # Member rows are relabelled on every union, so they always point at the current root
+            members = self._conn.execute(f"SELECT ckey FROM {graph}_members WHERE root=?", (row[0],)).fetchall()
+        return sorted(member[0] for member in members if member[0] != ckey)
@@ -1,8 +1,18 @@
 # Standard Imports
+import abc
 import asyncio
+import contextlib
+import csv
+import gzip
+import heapq
+import io
 import ipaddress
+import json
 import logging
 import socket
+import sqlite3
+import tempfile
+import time
 from typing import Union
 
 import aiomysql
@@ -12,11 +22,14 @@ import discord
 
 # Redbot Imports
 from redbot.core import Config, checks, commands
+from redbot.core.data_manager import cog_data_path
 from redbot.core.utils.chat_formatting import box, humanize_list, pagify, warning
-from redbot.core.utils.menus import DEFAULT_CONTROLS, menu
+from redbot.core.utils.menus import close_menu, menu
 
 # Util Imports
-from .util import key_to_ckey
+from .altindex import AltIndex
+from .cache import TTLCache
+from .util import key_to_ckey, parse_ip_range
 
 __version__ = "1.2.1"
 __author__ = "Crossedfall"
@@ -25,6 +38,189 @@ log = logging.getLogger("red.cog.SS13GetNotes")
 
 BaseCog = getattr(commands, "Cog", object)
 
+POOL_MAX_SIZE = 5
+POOL_RECYCLE = 3600  # Seconds before an idle connection is replaced
+POOL_CONNECT_TIMEOUT = 5  # Seconds before connecting to an unreachable database gives up
+ALT_QUERY_CHUNK = 500  # Maximum number of identifiers in a single IN (...) clause
+ALT_SEARCH_NODE_BUDGET = 25000  # Identifiers a live alt search may visit before it stops
+ALT_SEARCH_TIME_BUDGET = 120  # Seconds a live alt search may run before it stops
+ALT_SEARCH_PROGRESS_INTERVAL = 5  # Seconds between progress updates of a live alt search
+EXPORT_BATCH = 1000  # Rows read from the server-side cursor at a time during exports
+EXPORT_PROGRESS_INTERVAL = 5  # Seconds between progress updates of an export
+REDACTION_DELAY = 300  # Seconds before findplayer results have their CID and IP redacted
+NOTES_PAGE_SIZE = 10  # Notes fetched each time the notes menu needs another page
+RANGE_PAGE_SIZE = 15  # Ckeys fetched each time the IP range menu needs another page
+RANGE_MAX_ADDRESSES = 2 ** 24  # Largest IP range that can be searched, a /8
+PLAYER_CACHE_SIZE = 512  # Player profiles and note lists kept in memory
+PLAYER_CACHE_TTL = 60  # Seconds before a cached profile or note list is fetched again
+ALT_INDEX_INTERVAL = 600  # Seconds between alt index updates
+ALT_INDEX_BATCH = 10000  # connection_log rows fetched per batch
+ALT_INDEX_MAX_BATCHES = 100  # Upper bound of batches per update, the rest is picked up by the next one
+
+
+class AltSearch:
+    """
+    Progress of a live alt search, readable while the search is running
+    """
+
+    def __init__(self, target: str, check_ips: bool):
+        self.target = target
+        self.check_ips = check_ips
+        self.alts = []
+        self.visited = 0
+        self.frontier = 0
+        self.complete = False
+        self.stopped = False
+        self.started = time.monotonic()
+
+    def stop(self):
+        """
+        Asks the search to stop before its next query, cancelling the task instead could hand a pooled connection
+        back with an unread result on it
+        """
+        self.stopped = True
+
+    def should_stop(self) -> bool:
+        return (
+            self.stopped
+            or self.visited >= ALT_SEARCH_NODE_BUDGET
+            or time.monotonic() - self.started >= ALT_SEARCH_TIME_BUDGET
+        )
+
+
+class LazyPager(abc.ABC):
+    """
+    Menu pages fetched from the database as the menu is navigated, subclasses implement `fetch_next`
+    """
+
+    def __init__(self, cog, guild: discord.Guild, total: int):
+        self.cog = cog
+        self.guild = guild
+        self.total = total
+        self.pages = []
+        self.fetched = 0
+
+    @property
+    def exhausted(self) -> bool:
+        return self.fetched >= self.total
+
+    @abc.abstractmethod
+    async def fetch_next(self):
+        """
+        Fetches the next chunk of rows and appends their pages to `pages`
+        """
+
+    def controls(self) -> dict:
+        return {
+            "\N{LEFTWARDS BLACK ARROW}\N{VARIATION SELECTOR-16}": self.prev_page,
+            "\N{CROSS MARK}": close_menu,
+            "\N{BLACK RIGHTWARDS ARROW}\N{VARIATION SELECTOR-16}": self.next_page,
+        }
+
+    async def _show(self, ctx, pages, controls, message, page, timeout, emoji):
+        perms = message.channel.permissions_for(ctx.me)
+        if perms.manage_messages:
+            with contextlib.suppress(discord.NotFound):
+                await message.remove_reaction(emoji, ctx.author)
+        return await menu(ctx, pages, controls, message=message, page=page, timeout=timeout)
+
+    async def next_page(self, ctx, pages, controls, message, page, timeout, emoji, **kwargs):
+        if page + 1 >= len(pages):
+            await self.fetch_next()
+        return await self._show(ctx, pages, controls, message, min(page + 1, len(pages) - 1), timeout, emoji)
+
+    async def prev_page(self, ctx, pages, controls, message, page, timeout, emoji, **kwargs):
+        return await self._show(ctx, pages, controls, message, max(page - 1, 0), timeout, emoji)
+
+
+class NotesPager(LazyPager):
+    """
+    Menu pages for a player's notes
+
+    Notes are read newest first in chunks of NOTES_PAGE_SIZE using keyset pagination on (timestamp, id).
+    """
+
+    def __init__(self, cog, guild: discord.Guild, ckey: str, total: int):
+        super().__init__(cog, guild, total)
+        self.ckey = ckey
+        self.cursor = None  # (timestamp, id) of the last fetched note
+
+    async def fetch_next(self):
+        if self.exhausted:
+            return
+        cache_key = ("notes", self.guild.id, self.ckey, self.cursor)
+        rows = self.cog._player_cache.get(cache_key)
+        if rows is None:
+            prefix = await self.cog.config.guild(self.guild).mysql_prefix()
+            query = f"SELECT id, timestamp, adminckey, text, type FROM {prefix}messages WHERE targetckey=%s AND deleted = 0"
+            args = (self.ckey,)
+            if self.cursor is not None:
+                query += " AND (timestamp < %s OR (timestamp = %s AND id < %s))"
+                args += (self.cursor[0], self.cursor[0], self.cursor[1])
+            query += f" ORDER BY timestamp DESC, id DESC LIMIT {NOTES_PAGE_SIZE}"
+            rows = await self.cog.query_database(self.guild, query, args)
+            self.cog._player_cache.set(cache_key, rows)
+        if not rows:
+            # Notes were deleted since they were counted
+            self.total = self.fetched
+            return
+
+        first = self.fetched + 1
+        self.fetched += len(rows)
+        self.cursor = (rows[-1]["timestamp"], rows[-1]["id"])
+        # Parse the data into individual fields within an embeded message in Discord for ease of viewing
+        notes = ""
+        for row in rows:
+            notes += f"\n[{row['timestamp']} | {row['type']} by {row['adminckey']}]\n{row['text']}"
+        for note in pagify(notes, ["\n["]):
+            embed = discord.Embed(description=box(note, lang="asciidoc"), color=0xF1D592)
+            embed.set_author(name=f"Notes for {str(self.ckey).title()} | Total notes: {self.total}")
+            embed.set_footer(text=f"Notes {first}-{self.fetched} of {self.total} | All times are server time")
+            self.pages.append(embed)
+
+
+class RangePager(LazyPager):
+    """
+    Menu pages for the ckeys that connected from an IP range, grouped by ckey and most recently seen first
+    """
+
+    def __init__(self, cog, guild: discord.Guild, label: str, low: int, high: int, total: int, color):
+        super().__init__(cog, guild, total)
+        self.label = label
+        self.low = low
+        self.high = high
+        self.color = color
+
+    async def fetch_next(self):
+        if self.exhausted:
+            return
+        prefix = await self.cog.config.guild(self.guild).mysql_prefix()
+        query = (
+            "SELECT c.ckey, COUNT(*) AS connections, MIN(c.datetime) AS first_seen, MAX(c.datetime) AS last_seen, "
+            f"EXISTS(SELECT 1 FROM {prefix}player p WHERE p.ckey=c.ckey AND p.ip BETWEEN %s AND %s) AS current_ip "
+            f"FROM {prefix}connection_log c WHERE c.ip BETWEEN %s AND %s "
+            f"GROUP BY c.ckey ORDER BY last_seen DESC, c.ckey LIMIT {RANGE_PAGE_SIZE} OFFSET {self.fetched}"
+        )
+        rows = await self.cog.query_database(self.guild, query, (self.low, self.high, self.low, self.high))
+        if not rows:
+            self.total = self.fetched
+            return
+
+        first = self.fetched + 1
+        self.fetched += len(rows)
+        lines = []
+        for row in rows:
+            marker = "*" if row["current_ip"] else " "
+            lines.append(
+                f"{marker}{row['ckey']} | {row['connections']} connections | {row['first_seen']} - {row['last_seen']}"
+            )
+        embed = discord.Embed(description=box("\n".join(lines)), color=self.color)
+        embed.set_author(name=f"Players seen in {self.label} | Total players: {self.total}")
+        embed.set_footer(
+            text=f"Players {first}-{self.fetched} of {self.total} | * last connected from this range | All times are server time"
+        )
+        self.pages.append(embed)
+
 
 class GetNotes(BaseCog):
     def __init__(self, bot):
@@ -33,6 +229,7 @@ class GetNotes(BaseCog):
 
         default_global = {
             "config_version": None,
+            "redactions": [],  # Pending findplayer redactions, see schedule_redaction
         }
 
         default_guild = {
@@ -42,6 +239,7 @@ class GetNotes(BaseCog):
             "mysql_password": "password",
             "mysql_db": "feedback",
             "mysql_prefix": "",
+            "alt_index": False,
             "admin_ckey": {},  # Future thing, not currently used
         }
 
@@ -50,6 +248,32 @@ class GetNotes(BaseCog):
         self.loop = asyncio.get_event_loop()
         self.loop.create_task(self.version_check())
 
+        self._pools = {}  # guild id -> (connection settings, pool)
+        self._pool_locks = {}  # guild id -> lock held while the guild's pool is created
+
+        # ("profile" | "notes", guild id, ckey) -> cached rows
+        self._player_cache = TTLCache(PLAYER_CACHE_SIZE, PLAYER_CACHE_TTL)
+        self._alt_searches = {}  # (guild id, ckey) -> (live alt search task, AltSearch)
+        self._alt_indexes = {}  # guild id -> AltIndex
+        self._alt_index_lock = asyncio.Lock()
+        self._alt_index_updating = set()
+        self._alt_index_task = self.loop.create_task(self.alt_index_loop())
+
+        self._redactions = []  # Min-heap of (due, message id, channel id, ckey, account join date)
+        self._redactions_changed = asyncio.Event()
+        self._redactions_loaded = asyncio.Event()
+        self._redaction_task = self.loop.create_task(self.redaction_loop())
+
+    async def cog_unload(self):
+        self._redaction_task.cancel()
+        self._alt_index_task.cancel()
+        for task, _ in self._alt_searches.values():
+            task.cancel()
+        for index in self._alt_indexes.values():
+            index.close()
+        for guild_id in list(self._pools):
+            await self.invalidate_pool(guild_id)
+
     async def version_check(self):
         """
         Checks the current config version and send owner notices if needed
@@ -95,6 +319,7 @@ class GetNotes(BaseCog):
         """
         try:
             await self.config.guild(ctx.guild).mysql_host.set(db_host)
+            await self.invalidate_pool(ctx.guild.id)
             await ctx.send(f"Database host set to: `{db_host}`")
         except (ValueError, KeyError, AttributeError):
             await ctx.send(
@@ -110,6 +335,7 @@ class GetNotes(BaseCog):
         try:
             if 1024 <= db_port <= 65535:  # We don't want to allow reserved ports to be set
                 await self.config.guild(ctx.guild).mysql_port.set(db_port)
+                await self.invalidate_pool(ctx.guild.id)
                 await ctx.send(f"Database port set to: `{db_port}`")
             else:
                 await ctx.send(f"{db_port} is not a valid port!")
@@ -128,6 +354,7 @@ class GetNotes(BaseCog):
         """
         try:
             await self.config.guild(ctx.guild).mysql_user.set(user)
+            await self.invalidate_pool(ctx.guild.id)
             await ctx.send(f"User set to: `{user}`")
         except (ValueError, KeyError, AttributeError):
             await ctx.send("There was a problem setting the username for your database.")
@@ -142,6 +369,7 @@ class GetNotes(BaseCog):
         """
         try:
             await self.config.guild(ctx.guild).mysql_password.set(passwd)
+            await self.invalidate_pool(ctx.guild.id)
             await ctx.send("Your password has been set.")
             try:
                 await ctx.message.delete()
@@ -160,6 +388,7 @@ class GetNotes(BaseCog):
         """
         try:
             await self.config.guild(ctx.guild).mysql_db.set(db)
+            await self.invalidate_pool(ctx.guild.id)
             await ctx.send(f"Database set to: `{db}`")
         except (ValueError, KeyError, AttributeError):
             await ctx.send("There was a problem setting your notes database.")
@@ -183,6 +412,46 @@ class GetNotes(BaseCog):
         except (ValueError, KeyError, AttributeError):
             await ctx.send("There was a problem setting your database prefix")
 
+    @setnotes.command()
+    @checks.is_owner()
+    async def altindex(self, ctx, enabled: bool):
+        """
+        Enables or disables the local alt account index
+
+        When enabled, the connection_log table is indexed in the background and `alts` answers from the index.
+        The first build of the index can take a while on large tables.
+        """
+        await self.config.guild(ctx.guild).alt_index.set(enabled)
+        if enabled:
+            self.loop.create_task(self.update_alt_index(ctx.guild))
+            await ctx.send("Alt index enabled, it will be built in the background.")
+        else:
+            await ctx.send("Alt index disabled.")
+
+    @setnotes.command()
+    async def cachestats(self, ctx):
+        """
+        Shows how often player lookups were answered from the cache
+        """
+        cache = self._player_cache
+        total = cache.hits + cache.misses
+        ratio = round(cache.hits / total * 100, 1) if total else 0
+        await ctx.send(
+            box(f"Entries: {len(cache)}/{cache.maxsize}\nHits: {cache.hits}\nMisses: {cache.misses}\nHit ratio: {ratio}%")
+        )
+
+    @setnotes.command()
+    async def invalidate(self, ctx, *, ckey: str = None):
+        """
+        Drops cached player lookups for a ckey, or for everyone in this server if no ckey is given
+        """
+        if ckey is None:
+            removed = self._player_cache.discard_matching(lambda key: key[1] == ctx.guild.id)
+        else:
+            ckey = key_to_ckey(ckey).lower()
+            removed = self._player_cache.discard_matching(lambda key: key[1] == ctx.guild.id and key[2] == ckey)
+        await ctx.send(f"Removed {removed} cached entries.")
+
     @setnotes.command()
     async def current(self, ctx):
         """
@@ -210,34 +479,22 @@ class GetNotes(BaseCog):
 
         prefix = await self.config.guild(ctx.guild).mysql_prefix()
 
-        query = f"SELECT timestamp, adminckey, text, type FROM {prefix}messages WHERE targetckey=%s AND deleted = 0 ORDER BY timestamp DESC"
+        query = f"SELECT COUNT(*) AS total FROM {prefix}messages WHERE targetckey=%s AND deleted = 0"
         message = await ctx.send("Getting player notes...")
 
         try:
-            rows = await self.query_database(ctx.guild, query, ckey.lower())
-            if not rows:
+            total = self._player_cache.get(("notes", ctx.guild.id, ckey.lower(), "total"))
+            if total is None:
+                total = (await self.query_database(ctx.guild, query, ckey.lower()))[0]["total"]
+                self._player_cache.set(("notes", ctx.guild.id, ckey.lower(), "total"), total)
+            pager = NotesPager(self, ctx.guild, ckey.lower(), total)
+            await pager.fetch_next()
+            if not pager.pages:
                 embed = discord.Embed(description=f"No notes found for: {str(ckey).title()}", color=0xF1D592)
                 return await message.edit(content=None, embed=embed)
-            # Parse the data into individual fields within an embeded message in Discord for ease of viewing
-            notes = ""
-            total = 0
-            temp_embeds = []
-            embeds = []
-            for row in rows:
-                total += 1
-                notes += f"\n[{row['timestamp']} | {row['type']} by {row['adminckey']}]\n{row['text']}"
-            for note in pagify(notes, ["\n["]):
-                embed = discord.Embed(description=box(note, lang="asciidoc"), color=0xF1D592)
-                temp_embeds.append(embed)
-            max_i = len(temp_embeds)
-            i = 1
-            for embed in temp_embeds:
-                embed.set_author(name=f"Notes for {str(ckey).title()} | Total notes: {total}")
-                embed.set_footer(text=f"Page {i}/{max_i} | All times are server time")
-                embeds.append(embed)
-                i += 1
+
             await message.delete()
-            await menu(ctx, embeds, DEFAULT_CONTROLS)
+            await menu(ctx, pager.pages, pager.controls())
 
         except aiomysql.Error as err:
             embed = discord.Embed(
@@ -252,23 +509,31 @@ class GetNotes(BaseCog):
 
     async def player_search(self, ctx, ip=None, ckey=None, cid=None) -> dict:
         """
-        Runs multiple database queries to obtain the player's information
+        Obtains the player's information in a single database round-trip
         """
         prefix = await self.config.guild(ctx.guild).mysql_prefix()
 
-        # First query is determined by the identifier given
+        # The player lookup is determined by the identifier given
         if ip:
             # IPs are stored as a 32 bit integer in the databse. We need to convert it before doing the query.
-            query = f"SELECT ckey, firstseen, lastseen, computerid, ip, accountjoindate FROM {prefix}player WHERE ip=%s"
-            query = await self.query_database(ctx.guild, query, int(ipaddress.IPv4Address(ip)))
+            column, target = "ip", int(ipaddress.IPv4Address(ip))
         elif ckey:
-            query = (
-                f"SELECT ckey, firstseen, lastseen, computerid, ip, accountjoindate FROM {prefix}player WHERE ckey=%s"
-            )
-            query = await self.query_database(ctx.guild, query, ckey)
+            column, target = "ckey", ckey
         elif cid:
-            query = f"SELECT ckey, firstseen, lastseen, computerid, ip, accountjoindate FROM {prefix}player WHERE computerid=%s"
-            query = await self.query_database(ctx.guild, query, cid)
+            column, target = "computerid", cid
+        else:
+            return None
+
+        if column == "ckey":
+            cached = self._player_cache.get(("profile", ctx.guild.id, ckey.lower()))
+            if cached is not None:
+                return cached
+
+        try:
+            query = await self.query_database(ctx.guild, self.player_query(prefix, column), target)
+        except aiomysql.ProgrammingError:
+            # Not every schema has the role_time table
+            query = await self.query_database(ctx.guild, self.player_query(prefix, column, role_time=False), target)
 
         results = {}
         try:
@@ -283,55 +548,15 @@ class GetNotes(BaseCog):
         results["first"] = query["firstseen"]
         results["last"] = query["lastseen"]
         results["join"] = query["accountjoindate"]
-
-        # Obtain the number of total connections
-        query = f"SELECT COUNT(*) FROM {prefix}connection_log WHERE ckey=%s"
-        query = await self.query_database(ctx.guild, query, results["ckey"])
-        results["num_connections"] = query[0]["COUNT(*)"]
-
-        # Obtain the number of total deaths
-        query = f"SELECT COUNT(*) FROM {prefix}death WHERE byondkey=%s"
-        query = await self.query_database(ctx.guild, query, results["ckey"])
-        results["num_deaths"] = query[0]["COUNT(*)"]
-
-        # Obtain role time statistics
-        query = f"SELECT job, minutes FROM {prefix}role_time WHERE ckey=%s AND (job='Ghost' OR job='Living')"
-        try:
-            query = await self.query_database(ctx.guild, query, ckey)
-        except aiomysql.Error:
-            query = None
-
-        if query:
-            for job in query:
-                if job["job"] == "Living":
-                    results["living_time"] = job["minutes"] // 60
-                else:
-                    results["ghost_time"] = job["minutes"] // 60
-
-            if "living_time" not in results.keys():
-                results["living_time"] = 0
-            if "ghost_time" not in results.keys():
-                results["ghost_time"] = 0
-
-        else:
-            results["living_time"] = 0
-            results["ghost_time"] = 0
-
+        results["num_connections"] = query["num_connections"]
+        results["num_deaths"] = query["num_deaths"]
+        results["living_time"] = (query["living_minutes"] or 0) // 60
+        results["ghost_time"] = (query["ghost_minutes"] or 0) // 60
         results["total_time"] = results["living_time"] + results["ghost_time"]
-
-        # Obtain the number of bans and, if applicable, the last ban
-        query = f"SELECT bantime FROM {prefix}ban WHERE ckey=%s GROUP BY bantime ORDER BY bantime DESC"
-        query = await self.query_database(ctx.guild, query, results["ckey"])
-        results["num_bans"] = len(query)
-        if results["num_bans"] > 0:
-            results["latest_ban"] = list(query[0].values())[0]
-        else:
-            results["latest_ban"] = None
-
-        # Obtain the total number of notes
-        query = f"SELECT COUNT(*) FROM {prefix}messages WHERE targetckey=%s"
-        query = await self.query_database(ctx.guild, query, results["ckey"])
-        results["notes"] = query[0]["COUNT(*)"]
+        # Bans are grouped by when they were issued
+        results["num_bans"] = query["num_bans"]
+        results["latest_ban"] = query["latest_ban"]
+        results["notes"] = query["notes"]
 
         # Notes/Deaths per hour
         if results["living_time"] > 0:
@@ -341,8 +566,31 @@ class GetNotes(BaseCog):
             results["notes_per_hour"] = 0
             results["deaths_per_hour"] = 0
 
+        self._player_cache.set(("profile", ctx.guild.id, results["ckey"]), results)
         return results
 
+    @staticmethod
+    def player_query(prefix: str, column: str, role_time: bool = True) -> str:
+        """
+        Builds the player profile query, every statistic is gathered through a correlated subquery
+        """
+        if role_time:
+            living = f"(SELECT minutes FROM {prefix}role_time WHERE ckey=p.ckey AND job='Living')"
+            ghost = f"(SELECT minutes FROM {prefix}role_time WHERE ckey=p.ckey AND job='Ghost')"
+        else:
+            living = ghost = "0"
+        return (
+            "SELECT p.ckey, p.firstseen, p.lastseen, p.computerid, p.ip, p.accountjoindate, "
+            f"(SELECT COUNT(*) FROM {prefix}connection_log WHERE ckey=p.ckey) AS num_connections, "
+            f"(SELECT COUNT(*) FROM {prefix}death WHERE byondkey=p.ckey) AS num_deaths, "
+            f"{living} AS living_minutes, "
+            f"{ghost} AS ghost_minutes, "
+            f"(SELECT COUNT(DISTINCT bantime) FROM {prefix}ban WHERE ckey=p.ckey) AS num_bans, "
+            f"(SELECT MAX(bantime) FROM {prefix}ban WHERE ckey=p.ckey) AS latest_ban, "
+            f"(SELECT COUNT(*) FROM {prefix}messages WHERE targetckey=p.ckey) AS notes "
+            f"FROM {prefix}player p WHERE p.{column}=%s LIMIT 1"
+        )
+
     @commands.command(aliases=["ckey"])
     async def playerinfo(self, ctx, *, ckey: str):
         """
@@ -395,10 +643,14 @@ class GetNotes(BaseCog):
         Obtains information about a specific player.
 
         Will search for players using a provided IP, CID, or CKEY.
+        An IP range (`1.2.3.0/24` or `1.2.3.4-1.2.3.60`) lists every player that connected from it.
         """
 
         try:
             message = await ctx.send("Looking up player....")
+            if type(identifier) is str and parse_ip_range(identifier) is not None:
+                return await self.range_search(ctx, message, identifier)
+
             async with ctx.typing():
 
                 if type(identifier) is ipaddress.IPv4Address:
@@ -453,18 +705,7 @@ class GetNotes(BaseCog):
             await message.edit(content=None, embed=embed)
 
             # After 5-minutes redact the player's CID and IP.
-            await asyncio.sleep(300)
-            embed.set_field_at(
-                0,
-                name="__Identity:__",
-                value=f"**CKEY**: {player['ckey']}\n"
-                f"**CID**: `[DATA EXPUNGED]`\n"
-                f"**IP**: `[DATA EXPUNGED]`\n"
-                f"**Account Join Date**: {player['join']}",
-                inline=False,
-            )
-
-            await message.edit(content=None, embed=embed)
+            await self.schedule_redaction(message, player)
 
         except ValueError:
             return await message.edit(content="No results found.")
@@ -478,20 +719,217 @@ class GetNotes(BaseCog):
                 content="`mysql-connector` requirement not found! Please install this requirement using `pip install mysql-connector`."
             )
 
+    @checks.mod_or_permissions(administrator=True)
+    @commands.command()
+    async def exportplayer(self, ctx, ckey: str, file_format: str = "csv"):
+        """
+        Exports a player's full note, ban and connection history as compressed files
+
+        `file_format` can be `csv` or `jsonl`. Rows are streamed from the database, so any history size can be exported.
+        """
+        file_format = file_format.lower()
+        if file_format not in ("csv", "jsonl"):
+            return await ctx.send("The format must be either `csv` or `jsonl`.")
+        ckey = key_to_ckey(ckey).lower()
+        prefix = await self.config.guild(ctx.guild).mysql_prefix()
+        exports = (
+            ("notes", f"SELECT * FROM {prefix}messages WHERE targetckey=%s ORDER BY timestamp"),
+            ("bans", f"SELECT * FROM {prefix}ban WHERE ckey=%s ORDER BY bantime"),
+            ("connections", f"SELECT * FROM {prefix}connection_log WHERE ckey=%s ORDER BY id"),
+        )
+        message = await ctx.send(f"Exporting history for {ckey}...")
+
+        files = []
+        try:
+            for name, query in exports:
+                files.append(await self.export_rows(ctx.guild, query, ckey, file_format, f"{ckey}_{name}", message))
+        except aiomysql.Error as err:
+            for export in files:
+                export.close()
+            embed = discord.Embed(title=f"Error exporting history for: {ckey}", description=f"{format(err)}", color=0xFF0000)
+            return await message.edit(content=None, embed=embed)
+
+        size = sum(export.fp.seek(0, io.SEEK_END) for export in files)
+        for export in files:
+            export.fp.seek(0)
+        if size > ctx.guild.filesize_limit:
+            for export in files:
+                export.close()
+            return await message.edit(content=f"The export for {ckey} is too large to upload ({size} bytes).")
+        await ctx.send(f"History export for {ckey}:", files=files)
+        await message.delete()
+
+    async def export_rows(
+        self, guild: discord.Guild, query: str, target, file_format: str, name: str, message: discord.Message
+    ) -> discord.File:
+        """
+        Streams the query's rows into a gzip compressed temporary file and returns it as an attachment
+        """
+        buffer = tempfile.TemporaryFile()
+        text = io.TextIOWrapper(gzip.GzipFile(fileobj=buffer, mode="wb"), encoding="utf-8", newline="")
+        writer = None
+        count = 0
+        last_progress = time.monotonic()
+        try:
+            async for rows in self.stream_database(guild, query, target, EXPORT_BATCH):
+                for row in rows:
+                    if isinstance(row.get("ip"), int):
+                        row["ip"] = str(ipaddress.IPv4Address(row["ip"]))
+                if file_format == "jsonl":
+                    text.writelines(json.dumps(row, default=str) + "\n" for row in rows)
+                else:
+                    if writer is None:
+                        writer = csv.DictWriter(text, fieldnames=list(rows[0].keys()))
+                        writer.writeheader()
+                    writer.writerows(rows)
+                count += len(rows)
+                if time.monotonic() - last_progress >= EXPORT_PROGRESS_INTERVAL:
+                    last_progress = time.monotonic()
+                    await message.edit(content=f"Exporting {name}... {count} rows so far")
+            text.close()
+        except BaseException:
+            buffer.close()
+            raise
+        buffer.seek(0)
+        return discord.File(buffer, filename=f"{name}.{file_format}.gz")
+
+    async def schedule_redaction(self, message: discord.Message, player: dict):
+        """
+        Queues the CID and IP of a findplayer result to be redacted after REDACTION_DELAY seconds
+
+        The queue is saved to the config so pending redactions survive restarts.
+        """
+        await self._redactions_loaded.wait()
+        heapq.heappush(
+            self._redactions,
+            (time.time() + REDACTION_DELAY, message.id, message.channel.id, player["ckey"], str(player["join"])),
+        )
+        await self.config.redactions.set([list(entry) for entry in self._redactions])
+        self._redactions_changed.set()
+
+    async def redaction_loop(self):
+        self._redactions.extend(tuple(entry) for entry in await self.config.redactions())
+        heapq.heapify(self._redactions)
+        self._redactions_loaded.set()
+        await self.bot.wait_until_ready()
+
+        while True:
+            self._redactions_changed.clear()
+            if self._redactions:
+                timeout = max(self._redactions[0][0] - time.time(), 0)
+            else:
+                timeout = None
+            try:
+                await asyncio.wait_for(self._redactions_changed.wait(), timeout)
+                continue  # Something was queued, the earliest due time may have changed
+            except asyncio.TimeoutError:
+                pass
+
+            while self._redactions and self._redactions[0][0] <= time.time():
+                entry = heapq.heappop(self._redactions)
+                try:
+                    await self.redact(*entry[1:])
+                except Exception:
+                    # A single bad message must not stop the scheduler, every later result would stay unredacted
+                    log.exception(f"Failed to redact findplayer result {entry[1]}")
+                # Saved only once the entry was handled, so a crash mid redaction retries it on the next start
+                await self.config.redactions.set([list(entry) for entry in self._redactions])
+
+    async def redact(self, message_id: int, channel_id: int, ckey: str, join: str):
+        channel = self.bot.get_channel(channel_id)
+        if channel is None:
+            return
+        try:
+            message = await channel.fetch_message(message_id)
+            if not message.embeds:
+                return
+            embed = message.embeds[0]
+            embed.set_field_at(
+                0,
+                name="__Identity:__",
+                value=f"**CKEY**: {ckey}\n"
+                f"**CID**: `[DATA EXPUNGED]`\n"
+                f"**IP**: `[DATA EXPUNGED]`\n"
+                f"**Account Join Date**: {join}",
+                inline=False,
+            )
+            await message.edit(content=None, embed=embed)
+        except discord.HTTPException as err:
+            log.warning(f"Failed to redact findplayer result {message_id}: {err}")
+
+    async def range_search(self, ctx, message: discord.Message, identifier: str):
+        """
+        Lists the players that connected from an IP range using indexed range queries on the integer ip columns
+        """
+        low, high = parse_ip_range(identifier)
+        if high - low + 1 > RANGE_MAX_ADDRESSES:
+            return await message.edit(content="That range is too large, the largest searchable range is a /8.")
+        prefix = await self.config.guild(ctx.guild).mysql_prefix()
+
+        try:
+            query = f"SELECT COUNT(DISTINCT ckey) AS total FROM {prefix}connection_log WHERE ip BETWEEN %s AND %s"
+            total = (await self.query_database(ctx.guild, query, (low, high)))[0]["total"]
+            if not total:
+                return await message.edit(content="No results found.")
+
+            pager = RangePager(self, ctx.guild, identifier, low, high, total, await ctx.embed_color())
+            await pager.fetch_next()
+            if not pager.pages:
+                return await message.edit(content="No results found.")
+            await message.delete()
+            await menu(ctx, pager.pages, pager.controls())
+
+        except aiomysql.Error as err:
+            embed = discord.Embed(title="Error searching IP range", description=f"{format(err)}", color=0xFF0000)
+            return await message.edit(content=None, embed=embed)
+
     @checks.mod()
     @commands.command()
-    async def alts(self, ctx, ckey: str, check_ips: bool = True):
+    async def alts(self, ctx, ckey: str, check_ips: bool = True, live: bool = False):
         """
         Search for a list of possible alt accounts
 
-        This command can take a long time if there are a lot of alt accounts or if your connections table is very large!
+        If the alt index is enabled the results come from the index, set `live` to verify them against the database.
+
+        A live check stops with partial results once it has checked too many identifiers or has run for too long.
+        Use `altscancel` to stop a running check early.
         """
+        # The alt index and running searches are keyed by ckey, which the database compared case insensitively
+        ckey = key_to_ckey(ckey).lower()
         try:
             if check_ips is False:
                 await ctx.send(f"{warning('IP check bypassed')}")
             message = await ctx.send("Checking for alts...")
             async with ctx.typing():
-                alts = await self.get_alts(ctx, ckey, check_ips)
+                alts = None
+                search = None
+                if not live:
+                    alts = await self.get_indexed_alts(ctx.guild, ckey, check_ips)
+                if alts is None:
+                    job = (ctx.guild.id, ckey)
+                    if job in self._alt_searches:
+                        return await message.edit(content=f"An alt check for {ckey} is already running.")
+                    search = AltSearch(ckey, check_ips)
+                    task = self.loop.create_task(self.get_alts(ctx, ckey, check_ips, search))
+                    self._alt_searches[job] = (task, search)
+                    try:
+                        while not task.done():
+                            done, _ = await asyncio.wait({task}, timeout=ALT_SEARCH_PROGRESS_INTERVAL)
+                            if not done:
+                                await message.edit(
+                                    content=f"Checking for alts... {search.visited} identifiers checked, {search.frontier} queued"
+                                )
+                    finally:
+                        self._alt_searches.pop(job, None)
+                    if not task.cancelled():
+                        task.result()  # Re-raises database errors
+                    alts = search.alts
+                if search is not None and not search.complete:
+                    await ctx.send(
+                        warning(
+                            f"The alt check was stopped after checking {search.visited} identifiers, the results below are partial."
+                        )
+                    )
                 if len(alts) > 0:
                     alts = humanize_list(alts)
                     if len(alts) < 1800:
@@ -509,77 +947,220 @@ class GetNotes(BaseCog):
             await ctx.send(embed=embed)
             return await message.delete()  # ^
 
-    async def get_alts(self, ctx, target: str, check_ips: bool) -> list:
-        """Performs a comprehensive check of the database for possible alt accounts"""
+    @checks.mod()
+    @commands.command()
+    async def altscancel(self, ctx, ckey: str):
+        """
+        Stops a running alt check, the alts found so far are still posted
+        """
+        ckey = key_to_ckey(ckey).lower()
+        running = self._alt_searches.get((ctx.guild.id, ckey))
+        if running is None:
+            return await ctx.send(f"There is no alt check running for {ckey}.")
+        running[1].stop()
+        await ctx.send(f"Stopping the alt check for {ckey}.")
+
+    async def get_alts(self, ctx, target: str, check_ips: bool, search: AltSearch = None) -> list:
+        """
+        Performs a comprehensive check of the database for possible alt accounts
+
+        Progress and the alts found so far are kept on `search`, the check stops early once the search is over budget or asked to stop.
+        """
         # Credit for the original code goes to Qwerty (https://github.com/qwertyquerty)
+        # The alt graph is walked one layer at a time, each layer costs one query per identifier type (per chunk)
+        if search is None:
+            search = AltSearch(target, check_ips)
         prefix = await self.config.guild(ctx.guild).mysql_prefix()
-        caught_alts = []
-        investigated = []
-        to_investigate = [(target, "ckey")]
-
-        while len(to_investigate) > 0:
-            investigating = to_investigate.pop(len(to_investigate) - 1)
-            log.debug(f"Investigating: {investigating} :: Number to check: {len(to_investigate)}")
-
-            linked = []
-
-            if investigating[1] == "ckey":
-                linked = await self.query_database(
-                    ctx.guild,
-                    f"SELECT ckey, ip, computerid FROM {prefix}connection_log WHERE ckey=%s",
-                    investigating[0],
-                )
-            if investigating[1] == "computerid":
-                linked = await self.query_database(
-                    ctx.guild,
-                    f"SELECT ckey, ip, computerid FROM {prefix}connection_log WHERE computerid=%s",
-                    investigating[0],
-                )
-            if investigating[1] == "ip" and check_ips is True:
-                linked = await self.query_database(
-                    ctx.guild,
-                    f"SELECT ckey, ip, computerid FROM {prefix}connection_log WHERE ip=%s",
-                    investigating[0],
-                )
-
-            investigated.append(investigating)
-
-            for link in linked:
-                if (link["ckey"], "ckey") not in investigated and (link["ckey"], "ckey") not in to_investigate:
-                    to_investigate.append((link["ckey"], "ckey"))
-
-                    if link["ckey"] not in caught_alts:
-                        caught_alts.append(link["ckey"])
-
-                if (link["computerid"], "computerid") not in investigated and (
-                    link["computerid"],
-                    "computerid",
-                ) not in to_investigate:
-                    to_investigate.append((link["computerid"], "computerid"))
+        columns = ("ckey", "computerid", "ip") if check_ips else ("ckey", "computerid")
+        caught_alts = search.alts
+        investigated = {column: set() for column in columns}
+        to_investigate = {column: set() for column in columns}
+        investigated["ckey"].add(target)
+        to_investigate["ckey"].add(target)
+
+        while any(to_investigate.values()):
+            search.frontier = sum(len(v) for v in to_investigate.values())
+            log.debug(f"Investigating: {search.frontier} identifiers")
+
+            next_investigate = {column: set() for column in columns}
+            for column, values in to_investigate.items():
+                values = list(values)
+                for i in range(0, len(values), ALT_QUERY_CHUNK):
+                    if search.should_stop():
+                        return caught_alts
+                    chunk = values[i : i + ALT_QUERY_CHUNK]
+                    placeholders = ", ".join(["%s"] * len(chunk))
+                    linked = await self.query_database(
+                        ctx.guild,
+                        f"SELECT DISTINCT ckey, ip, computerid FROM {prefix}connection_log WHERE {column} IN ({placeholders})",
+                        chunk,
+                    )
+                    search.visited += len(chunk)
+                    search.frontier -= len(chunk)
+
+                    # Links are recorded right away so a stopped search still reports everything it has seen
+                    for link in linked:
+                        for link_column in columns:
+                            if link[link_column] not in investigated[link_column]:
+                                investigated[link_column].add(link[link_column])
+                                next_investigate[link_column].add(link[link_column])
+                                if link_column == "ckey":
+                                    caught_alts.append(link["ckey"])
+            to_investigate = next_investigate
+
+        search.complete = True
+        return caught_alts
 
-                if (
-                    (link["ip"], "ip") not in investigated
-                    and (link["ip"], "ip") not in to_investigate
-                    and check_ips is True
-                ):
-                    to_investigate.append((link["ip"], "ip"))
+    async def get_alt_index(self, guild: discord.Guild) -> AltIndex:
+        index = self._alt_indexes.get(guild.id)
+        if index is not None:
+            return index
+        # Opening the file happens in an executor, so concurrent callers must not each open their own connection
+        async with self._alt_index_lock:
+            index = self._alt_indexes.get(guild.id)
+            if index is None:
+                index = await self.loop.run_in_executor(None, AltIndex, cog_data_path(self) / f"altindex_{guild.id}.sqlite3")
+                self._alt_indexes[guild.id] = index
+        return index
+
+    async def get_indexed_alts(self, guild: discord.Guild, target: str, check_ips: bool):
+        """
+        Looks up possible alt accounts in the alt index
 
-        return caught_alts
+        Returns None if the index is disabled, not built yet, or has never seen the ckey.
+        """
+        if not await self.config.guild(guild).alt_index():
+            return None
+        index = await self.get_alt_index(guild)
+        if not await self.loop.run_in_executor(None, index.is_built):
+            return None
+        return await self.loop.run_in_executor(None, index.component, target, check_ips)
 
-    async def query_database(self, guild: discord.Guild, query: str, target: str):
-        # Database options loaded from the config
-        db = await self.config.guild(guild).mysql_db()
-        db_host = socket.gethostbyname(await self.config.guild(guild).mysql_host())
-        db_port = await self.config.guild(guild).mysql_port()
-        db_user = await self.config.guild(guild).mysql_user()
-        db_pass = await self.config.guild(guild).mysql_password()
+    async def update_alt_index(self, guild: discord.Guild) -> bool:
+        """
+        Adds the connection_log rows past the index's watermark to the guild's alt index
 
-        conn = await aiomysql.connect(host=db_host, port=db_port, user=db_user, password=db_pass, db=db)
+        Returns False if there are rows left to index.
+        """
+        if guild.id in self._alt_index_updating:
+            return True
+        self._alt_index_updating.add(guild.id)
+        try:
+            settings = await self.config.guild(guild).all()
+            prefix = settings["mysql_prefix"]
+            source = f"{settings['mysql_host']}:{settings['mysql_port']}/{settings['mysql_db']}/{prefix}"
+            index = await self.get_alt_index(guild)
+            await self.loop.run_in_executor(None, index.ensure_source, source)
+            watermark = await self.loop.run_in_executor(None, index.watermark)
+
+            for _ in range(ALT_INDEX_MAX_BATCHES):
+                rows = await self.query_database(
+                    guild,
+                    f"SELECT id, ckey, computerid, ip FROM {prefix}connection_log WHERE id > %s ORDER BY id LIMIT {ALT_INDEX_BATCH}",
+                    watermark,
+                )
+                if not rows:
+                    break
+                await self.loop.run_in_executor(None, index.add_rows, rows)
+                watermark = rows[-1]["id"]
+                if len(rows) < ALT_INDEX_BATCH:
+                    break
+            else:
+                log.debug(f"Alt index for guild {guild.id} is at connection {watermark}, continuing shortly")
+                return False
+            await self.loop.run_in_executor(None, index.mark_built)
+            log.debug(f"Alt index for guild {guild.id} is up to connection {watermark}")
+            return True
+        except (aiomysql.Error, OSError, sqlite3.Error) as err:
+            log.warning(f"Failed to update the alt index for guild {guild.id}: {err}")
+            return True
+        finally:
+            self._alt_index_updating.discard(guild.id)
+
+    async def alt_index_loop(self):
+        await self.bot.wait_until_ready()
+        while True:
+            caught_up = True
+            try:
+                for guild_id, settings in (await self.config.all_guilds()).items():
+                    guild = self.bot.get_guild(guild_id)
+                    if guild is not None and settings.get("alt_index"):
+                        caught_up &= await self.update_alt_index(guild)
+            except Exception:
+                log.exception("Alt index update failed")
+            # An index that is still being built keeps going after a short break
+            await asyncio.sleep(ALT_INDEX_INTERVAL if caught_up else 5)
+
+    async def get_pool(self, guild: discord.Guild) -> aiomysql.Pool:
+        """
+        Returns the connection pool for the guild, creating it if needed
 
-        async with conn.cursor(aiomysql.DictCursor) as cur:
-            await cur.execute(query, (target))
-            rows = await cur.fetchall()
+        Pools are keyed by the guild's connection settings, so a pool created with outdated settings is replaced.
+        """
+        settings = await self.config.guild(guild).all()
+        key = tuple(settings[k] for k in ("mysql_host", "mysql_port", "mysql_user", "mysql_password", "mysql_db"))
+        cached = self._pools.get(guild.id)
+        if cached is not None and cached[0] == key and not cached[1].closed:
+            return cached[1]
+
+        # Only creation is serialised, and only per guild, so an unreachable database doesn't hold up other guilds
+        async with self._pool_locks.setdefault(guild.id, asyncio.Lock()):
+            cached = self._pools.get(guild.id)
+            if cached is not None and cached[0] == key and not cached[1].closed:
+                return cached[1]
+            if cached is not None:
+                await self.invalidate_pool(guild.id)
+
+            db_host, db_port, db_user, db_pass, db = key
+            address = await asyncio.get_running_loop().getaddrinfo(db_host, db_port, type=socket.SOCK_STREAM)
+            pool = await aiomysql.create_pool(
+                host=address[0][4][0],
+                port=db_port,
+                user=db_user,
+                password=db_pass,
+                db=db,
+                minsize=1,
+                maxsize=POOL_MAX_SIZE,
+                pool_recycle=POOL_RECYCLE,
+                connect_timeout=POOL_CONNECT_TIMEOUT,
+                autocommit=True,  # Pooled connections would otherwise keep reading from a stale snapshot
+            )
+            self._pools[guild.id] = (key, pool)
+            log.debug(f"Created a new connection pool for guild {guild.id}")
+            return pool
 
-        conn.close()
+    async def invalidate_pool(self, guild_id: int):
+        """
+        Closes and forgets the guild's connection pool, it will be recreated on the next query
+        """
+        cached = self._pools.pop(guild_id, None)
+        if cached is None:
+            return
+        pool = cached[1]
+        pool.close()
+        await pool.wait_closed()
 
-        return rows
\ No newline at end of file
+    async def stream_database(self, guild: discord.Guild, query: str, target, batch: int):
+        """
+        Yields the query's rows in batches from an unbuffered server-side cursor
+        """
+        pool = await self.get_pool(guild)
+
+        async with pool.acquire() as conn:
+            async with conn.cursor(aiomysql.SSDictCursor) as cur:
+                await cur.execute(query, (target))
+                while True:
+                    rows = await cur.fetchmany(batch)
+                    if not rows:
+                        break
+                    yield rows
+
+    async def query_database(self, guild: discord.Guild, query: str, target):
+        pool = await self.get_pool(guild)
+
+        async with pool.acquire() as conn:
+            async with conn.cursor(aiomysql.DictCursor) as cur:
+                await cur.execute(query, (target))
+                rows = await cur.fetchall()
+
+        return rows
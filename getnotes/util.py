@@ -1,4 +1,22 @@
-import re
-
-def key_to_ckey(key):
-	return re.sub('[^A-Za-z0-9]+', '', key)
\ No newline at end of file
+import ipaddress
+import re
+
+def key_to_ckey(key):
+	return re.sub('[^A-Za-z0-9]+', '', key)
+
+def parse_ip_range(value):
+	"""
+	Parses a CIDR block (1.2.3.0/24) or an inclusive range (1.2.3.4-1.2.3.60) into integer (low, high) bounds
+
+	Returns None if the value is neither
+	"""
+	try:
+		if "/" in value:
+			network = ipaddress.IPv4Network(value.strip(), strict=False)
+			return int(network.network_address), int(network.broadcast_address)
+		if "-" in value:
+			low, high = (int(ipaddress.IPv4Address(part.strip())) for part in value.split("-", 1))
+			return min(low, high), max(low, high)
+	except ValueError:
+		return None
+	return None
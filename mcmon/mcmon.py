@@ -1,13 +1,26 @@
 import asyncio
+import random
 from datetime import datetime
 from logging import getLogger
+from time import monotonic
 
 import aiohttp
 from discord import Color, Embed, Message, TextChannel
 from redbot.core import Config, checks, commands
 
+from . import slp
+
 log = getLogger("red.mcmon")
 
+# how long a fetched status is reused for other guilds monitoring the same server
+STATUS_TTL = 15
+# upper bound on concurrent status requests
+MAX_CONCURRENT_CHECKS = 8
+# guild checks are spread over this many seconds when the scheduler starts
+STARTUP_STAGGER = 30
+# longest the scheduler sleeps before looking for newly due guilds
+MAX_SCHEDULER_SLEEP = 30
+
 
 class MCSrvStatus:
     def __init__(self, data):
@@ -26,29 +39,108 @@ class MCSrvStatus:
         self.software = data["software"]
 
     @classmethod
-    async def get_server_status(cls, server: str):
-        async with aiohttp.ClientSession() as session:
-            async with session.get(f"https://api.mcsrvstat.us/2/{server}") as resp:
-                return MCSrvStatus(await resp.json())
+    async def get_server_status(cls, server: str, session: aiohttp.ClientSession):
+        async with session.get(f"https://api.mcsrvstat.us/2/{server}") as resp:
+            return MCSrvStatus(await resp.json())
+
+    @classmethod
+    async def ping_server_status(cls, server: str):
+        """Queries the server directly with the Server List Ping protocol"""
+        response = await slp.ping(server)
+        host, port = slp.split_address(server)
+        players = response.get("players", {})
+        version = response.get("version", {})
+        data = {
+            "online": True,
+            "motd": {"clean": slp.flatten_description(response.get("description", "")).split("\n")},
+            "hostname": host,
+            "port": port,
+            "version": version.get("name"),
+            "players": {"online": players.get("online", 0), "max": players.get("max", 0)},
+            "icon": response.get("favicon"),
+            "software": None,
+        }
+        if players.get("sample"):
+            data["players"]["list"] = [player["name"] for player in players["sample"]]
+        return MCSrvStatus(data)
 
 
 class MCMon(commands.Cog):
     config: Config
+    _session: "aiohttp.ClientSession | None"
+    _inflight: "dict[str, asyncio.Future]"
+    _status_cache: "dict[str, tuple[float, MCSrvStatus]]"
+    _due: "dict[int, float]"
+    _scheduler: "asyncio.Task | None"
 
     def __init__(self, bot: commands.Bot) -> None:
         self.bot = bot
-        self.bot.add_listener(self.monitor, "on_guild_join")
+        self._session = None
+        self._inflight = {}
+        self._status_cache = {}
+        self._check_semaphore = asyncio.Semaphore(MAX_CONCURRENT_CHECKS)
+        self._due = {}
+        self._scheduler = None
         self.config = Config.get_conf(self, identifier=1234513213123)
         default_guild = {"enabled": False, "channel": None, "interval": 300, "servers": []}
         default_server = {"last_online": False, "server_message": None}
         self.config.register_guild(**default_guild)
         self.config.init_custom("server", 1)
         self.config.register_custom("server", **default_server)
-        for guild in self.bot.guilds:
-            self.bot.loop.create_task(self.monitor(guild))
 
+    async def cog_load(self) -> None:
+        self._scheduler = asyncio.create_task(self.scheduler())
+
+    async def cog_unload(self) -> None:
+        if self._scheduler is not None:
+            self._scheduler.cancel()
+            self._scheduler = None
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    @commands.Cog.listener()
     async def on_guild_join(self, guild):
-        self.bot.loop.create_task(self.monitor(guild))
+        self.schedule(guild)
+
+    @commands.Cog.listener()
+    async def on_guild_remove(self, guild):
+        self._due.pop(guild.id, None)
+
+    def schedule(self, guild, delay: float = 0) -> None:
+        """Schedules the next check of a guild's servers"""
+        self._due[guild.id] = monotonic() + delay
+
+    def get_session(self) -> aiohttp.ClientSession:
+        """Returns the session shared by all status requests, creating it if needed"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30))
+        return self._session
+
+    async def fetch_status(self, server: str) -> MCSrvStatus:
+        """
+        Fetches the status of a server.
+        Concurrent callers for the same server share a single request, and the result is reused for STATUS_TTL seconds.
+        """
+        cached = self._status_cache.get(server)
+        if cached and monotonic() - cached[0] < STATUS_TTL:
+            return cached[1]
+        pending = self._inflight.get(server)
+        if pending is None:
+            pending = asyncio.ensure_future(self._fetch_status(server))
+            self._inflight[server] = pending
+            pending.add_done_callback(lambda _: self._inflight.pop(server, None))
+        return await asyncio.shield(pending)
+
+    async def _fetch_status(self, server: str) -> MCSrvStatus:
+        async with self._check_semaphore:
+            try:
+                status = await MCSrvStatus.ping_server_status(server)
+            except (OSError, asyncio.TimeoutError, slp.SLPError) as err:
+                log.debug("Direct ping of %s failed, falling back to the status API: %s", server, err)
+                status = await MCSrvStatus.get_server_status(server, self.get_session())
+        self._status_cache[server] = (monotonic(), status)
+        return status
 
     @commands.group()
     @checks.admin_or_permissions(manage_guild=True)
@@ -112,12 +204,14 @@ class MCMon(commands.Cog):
     async def interval(self, ctx: commands.Context, interval: int) -> None:
         """Set the interval to check servers in seconds"""
         await self.config.guild(ctx.guild).interval.set(interval)
+        self.schedule(ctx.guild)
         await ctx.send("Interval set")
 
     @mcmon.command()
     async def start(self, ctx: commands.Context) -> None:
         """Start monitoring servers"""
         await self.config.guild(ctx.guild).enabled.set(True)
+        self.schedule(ctx.guild)
         await ctx.send("Monitoring started")
 
     @mcmon.command()
@@ -135,50 +229,86 @@ class MCMon(commands.Cog):
         else:
             await ctx.send("Monitoring is disabled")
 
-    async def monitor(self, guild) -> None:
+    async def scheduler(self) -> None:
+        """Runs the checks of every guild as they come due"""
         await self.bot.wait_until_ready()
-        log.info("Starting monitor for %s", guild.name)
-        while self is self.bot.get_cog("MCMon"):
+        for guild in self.bot.guilds:
+            self.schedule(guild, random.uniform(0, STARTUP_STAGGER))
+        while True:
+            try:
+                now = monotonic()
+                due = [guild_id for guild_id, when in self._due.items() if when <= now]
+                guilds = [guild for guild in map(self.bot.get_guild, due) if guild is not None]
+                for guild_id in due:
+                    self._due.pop(guild_id)
+                if guilds:
+                    await self.check_guilds(guilds)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("MCMon scheduler tick failed")
+            now = monotonic()
+            next_due = min(self._due.values(), default=now + MAX_SCHEDULER_SLEEP)
+            await asyncio.sleep(min(max(next_due - now, 1), MAX_SCHEDULER_SLEEP))
+
+    async def check_guilds(self, guilds) -> None:
+        """
+        Checks the servers of the given guilds.
+        Each server is fetched once even when several guilds monitor it.
+        """
+        targets = []
+        for guild in guilds:
+            guild_config = await self.config.guild(guild).all()
+            self.schedule(guild, guild_config["interval"])
+            if not guild_config["enabled"]:
+                continue
+            channel = self.bot.get_channel(guild_config["channel"])
+            if not channel:
+                continue
+            targets.append((guild, channel, guild_config["servers"]))
+
+        servers = {server for _, _, guild_servers in targets for server in guild_servers}
+        await asyncio.gather(*(self.fetch_status(server) for server in servers), return_exceptions=True)
+
+        for guild, channel, guild_servers in targets:
             log.info("Checking servers for %s", guild.name)
-            if await self.config.guild(guild).enabled():
-                log.info("Monitoring enabled for %s", guild.name)
-                servers = await self.config.guild(guild).servers()
-                channel = self.bot.get_channel(await self.config.guild(guild).channel())
-                if channel:
-                    log.info("Channel found for %s", guild.name)
-                    for server in servers:
-                        status = await MCSrvStatus.get_server_status(server)
-                        last_online = await self.config.custom("server", server).last_online()
-                        if status.online:
-                            update_stamp = int(str(datetime.now().timestamp()).split(".")[0]) + await self.config.guild(guild).interval()
-                            embed = Embed(
-                                title=f"{status.hostname}({status.version}) is online",
-                                description=f"**MOTD:** {status.motd}\n"
-                                f"**Players:** {status.players_online}/{status.players_max}\n"
-                                f"**Software:** {status.software}\n"
-                                f"**Next Update:** <t:{update_stamp}:R>",
-                                color=Color.green(),
-                            )
-                            embed.add_field(
-                                name="Players", value=(("```\n" + ("\n".join(status.players_list)) + "\n```") if status.players_list else "Unknown")
-                            )
-                            await self.config.last_online.set(status.online)
-                        else:
-                            if last_online:
-                                embed = Embed(
-                                    title=f"{status.hostname} is offline",
-                                    description=f"**Last online:** {last_online}",
-                                    color=Color.red(),
-                                )
-                            else:
-                                embed = None
-                        server_message = await self.config.custom("server", server).server_message()
-                        if server_message:
-                            log.info("Server message found for %s", guild.name)
-                            message = await channel.fetch_message(server_message)
-                            await message.edit(embed=embed)
-                        else:
-                            log.info("Server message not found for %s", guild.name)
-                            message = await channel.send(embed=embed)
-                            await self.config.custom("server", server).server_message.set(message.id)
-            await asyncio.sleep(await self.config.guild(guild).interval())
+            results = await asyncio.gather(*(self.update_server(guild, channel, server) for server in guild_servers), return_exceptions=True)
+            for server, result in zip(guild_servers, results):
+                if isinstance(result, Exception):
+                    log.error("Failed to update %s for %s: %s", server, guild.name, result)
+
+    async def update_server(self, guild, channel: TextChannel, server: str) -> None:
+        status = await self.fetch_status(server)
+        last_online = await self.config.custom("server", server).last_online()
+        if status.online:
+            update_stamp = int(str(datetime.now().timestamp()).split(".")[0]) + await self.config.guild(guild).interval()
+            embed = Embed(
+                title=f"{status.hostname}({status.version}) is online",
+                description=f"**MOTD:** {status.motd}\n"
+                f"**Players:** {status.players_online}/{status.players_max}\n"
+                f"**Software:** {status.software}\n"
+                f"**Next Update:** <t:{update_stamp}:R>",
+                color=Color.green(),
+            )
+            embed.add_field(
+                name="Players", value=(("```\n" + ("\n".join(status.players_list)) + "\n```") if status.players_list else "Unknown")
+            )
+            await self.config.custom("server", server).last_online.set(status.online)
+        else:
+            if last_online:
+                embed = Embed(
+                    title=f"{status.hostname} is offline",
+                    description=f"**Last online:** {last_online}",
+                    color=Color.red(),
+                )
+            else:
+                embed = None
+        server_message = await self.config.custom("server", server).server_message()
+        if server_message:
+            log.info("Server message found for %s", guild.name)
+            message = await channel.fetch_message(server_message)
+            await message.edit(embed=embed)
+        else:
+            log.info("Server message not found for %s", guild.name)
+            message = await channel.send(embed=embed)
+            await self.config.custom("server", server).server_message.set(message.id)
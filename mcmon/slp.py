@@ -0,0 +1,117 @@
+import asyncio
+import json
+import re
+import struct
+
+DEFAULT_PORT = 25565
+# -1 asks the server to answer with whatever protocol version it runs
+PROTOCOL_VERSION = -1
+# responses larger than this are rejected instead of buffered
+MAX_PACKET_LENGTH = 2 * 1024 * 1024
+
+_FORMATTING_CODES = re.compile("§[0-9a-fk-or]", re.IGNORECASE)
+
+
+class SLPError(Exception):
+    """Raised when a server does not answer a status request with a valid response"""
+
+
+def pack_varint(value: int) -> bytes:
+    value &= 0xFFFFFFFF
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def unpack_varint(data: bytes, offset: int = 0) -> "tuple[int, int]":
+    """Decodes a VarInt from data at offset, returning the value and the offset after it"""
+    value = 0
+    for i in range(5):
+        if offset >= len(data):
+            raise SLPError("Truncated VarInt")
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << (7 * i)
+        if not byte & 0x80:
+            if value & 0x80000000:
+                value -= 1 << 32
+            return value, offset
+    raise SLPError("VarInt is too long")
+
+
+async def read_varint(reader: asyncio.StreamReader) -> int:
+    value = 0
+    for i in range(5):
+        byte = (await reader.readexactly(1))[0]
+        value |= (byte & 0x7F) << (7 * i)
+        if not byte & 0x80:
+            return value
+    raise SLPError("VarInt is too long")
+
+
+def pack_string(value: str) -> bytes:
+    encoded = value.encode("utf-8")
+    return pack_varint(len(encoded)) + encoded
+
+
+def pack_packet(packet_id: int, payload: bytes = b"") -> bytes:
+    body = pack_varint(packet_id) + payload
+    return pack_varint(len(body)) + body
+
+
+def split_address(server: str) -> "tuple[str, int]":
+    host, sep, port = server.rpartition(":")
+    if sep and port.isdigit():
+        return host, int(port)
+    return server, DEFAULT_PORT
+
+
+def flatten_description(description) -> str:
+    """Flattens a chat component into plain text, stripping legacy formatting codes"""
+    if isinstance(description, str):
+        text = description
+    elif isinstance(description, dict):
+        text = description.get("text", "") + "".join(flatten_description(extra) for extra in description.get("extra", []))
+    elif isinstance(description, list):
+        text = "".join(flatten_description(part) for part in description)
+    else:
+        text = ""
+    return _FORMATTING_CODES.sub("", text)
+
+
+async def ping(server: str, timeout: float = 5) -> dict:
+    """
+    Queries a server with the Server List Ping protocol and returns the decoded status response.
+    The address may include a port, otherwise the default port is used.
+    """
+    host, port = split_address(server)
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    try:
+        handshake = pack_varint(PROTOCOL_VERSION) + pack_string(host) + struct.pack(">H", port) + pack_varint(1)
+        writer.write(pack_packet(0x00, handshake) + pack_packet(0x00))
+        await writer.drain()
+
+        length = await asyncio.wait_for(read_varint(reader), timeout)
+        if length <= 0 or length > MAX_PACKET_LENGTH:
+            raise SLPError(f"Invalid packet length {length}")
+        packet = await asyncio.wait_for(reader.readexactly(length), timeout)
+        packet_id, offset = unpack_varint(packet)
+        if packet_id != 0x00:
+            raise SLPError(f"Unexpected packet id {packet_id}")
+        string_length, offset = unpack_varint(packet, offset)
+        if string_length < 0 or offset + string_length > len(packet):
+            raise SLPError("Truncated status response")
+        try:
+            return json.loads(packet[offset : offset + string_length].decode("utf-8"))
+        except ValueError as err:
+            raise SLPError(f"Malformed status response: {err}") from err
+    except asyncio.IncompleteReadError as err:
+        raise SLPError("Connection closed before the status response was read") from err
+    finally:
+        writer.close()
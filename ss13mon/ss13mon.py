@@ -1,5 +1,7 @@
 import asyncio
 from datetime import datetime, timedelta
+import hashlib
+import json
 import logging
 import random
 from sys import stdout
@@ -13,18 +15,41 @@ import urllib.parse
 
 log = logging.getLogger("red.ss13mon")
 
+# status values kept in memory and only periodically written back to config
+STATE_KEYS = ("last_roundid", "last_title", "last_online", "last_online_auth")
+STATE_FLUSH_INTERVAL = 300
+# minimum time between two join/leave summaries for the same guild
+FEED_BATCH_INTERVAL = 60
+
 class SS13Mon(commands.Cog):
 	config: Config
 	_tasks: 'list[asyncio.Task]'
-
-	def cog_unload(self):
+	_state: 'dict[int, dict]'
+	_dirty: 'set[int]'
+	_embed_hashes: 'dict[int, dict[str, tuple[int, str]]]'
+	_update_hashes: 'dict[int, str]'
+	_snapshots: 'dict[int, set[str]]'
+	_sessions: 'dict[int, dict[str, float]]'
+	_feed_pending: 'dict[int, tuple[list, list]]'
+	_feed_last_post: 'dict[int, float]'
+
+	async def cog_unload(self):
 		for task in self._tasks:
 			task.cancel()
-		return super().cog_unload()
+		self._flush_task.cancel()
+		await self.flush_state()
 
 	def __init__(self, bot: commands.Bot) -> None:
 		self.bot = bot
 		self._tasks = list()
+		self._state = dict()
+		self._dirty = set()
+		self._embed_hashes = dict()
+		self._update_hashes = dict()
+		self._snapshots = dict()
+		self._sessions = dict()
+		self._feed_pending = dict()
+		self._feed_last_post = dict()
 		self.config = Config.get_conf(self, identifier=854168416161, force_registration=True)
 
 		def_guild = {
@@ -37,6 +62,7 @@ class SS13Mon(commands.Cog):
 			"port_auth": None,
 			"message_id": None,
 			"message_id_auth": None,
+			"feed_channel": None,
 			# internal status values
 			"last_roundid": None,
 			"last_title": None,
@@ -46,6 +72,7 @@ class SS13Mon(commands.Cog):
 		self.config.register_guild(**def_guild)
 		for guild in self.bot.guilds:
 			self.start_guild_update_loop(guild)
+		self._flush_task = asyncio.get_event_loop().create_task(self.state_flush_loop())
 
 	def start_guild_update_loop(self, guild):
 		task = asyncio.get_event_loop().create_task(self.update_guild_message(guild))
@@ -55,6 +82,69 @@ class SS13Mon(commands.Cog):
 	def _handle_task_completion(self, future: asyncio.Task):
 		self._tasks.remove(future)
 
+	async def get_state(self, guild: discord.Guild) -> dict:
+		"""
+		Returns the in-memory status values for a guild, loading them from config on first use
+		"""
+		state = self._state.get(guild.id)
+		if(state == None):
+			cfg = self.config.guild(guild)
+			state = dict()
+			for key in STATE_KEYS:
+				state[key] = await getattr(cfg, key)()
+			self._state[guild.id] = state
+		return state
+
+	async def set_state(self, guild: discord.Guild, **values):
+		state = await self.get_state(guild)
+		for key, value in values.items():
+			if(state[key] != value):
+				state[key] = value
+				self._dirty.add(guild.id)
+
+	async def flush_state(self):
+		"""
+		Writes any changed status values back to config
+		"""
+		dirty = self._dirty
+		self._dirty = set()
+		for guild_id in dirty:
+			state = self._state.get(guild_id)
+			if(state == None):
+				continue
+			cfg = self.config.guild_from_id(guild_id)
+			try:
+				for key in STATE_KEYS:
+					await getattr(cfg, key).set(state[key])
+			except Exception as err:
+				self._dirty.add(guild_id)
+				log.error("Failed to flush status values for guild {}: '{}'".format(guild_id, str(err)))
+
+	async def state_flush_loop(self):
+		while True:
+			await asyncio.sleep(STATE_FLUSH_INTERVAL)
+			await self.flush_state()
+
+	@staticmethod
+	def embed_digest(embed: discord.Embed) -> str:
+		"""
+		Hashes the rendered content of an embed, ignoring its timestamp
+		"""
+		data = embed.to_dict()
+		data.pop("timestamp", None)
+		return hashlib.sha1(json.dumps(data, sort_keys=True).encode()).hexdigest()
+
+	async def edit_if_changed(self, guild: discord.Guild, key: str, message: discord.Message, embed: discord.Embed):
+		"""
+		Edits the message with the given embed, unless the last embed sent to it had the same content
+		"""
+		hashes = self._embed_hashes.setdefault(guild.id, dict())
+		digest = self.embed_digest(embed)
+		if(hashes.get(key) == (message.id, digest)):
+			return
+		await message.edit(content=None, embed=embed)
+		hashes[key] = (message.id, digest)
+
 	@commands.command()
 	@commands.cooldown(1, 5)
 	async def ss13status(self, ctx: commands.Context):
@@ -107,6 +197,34 @@ class SS13Mon(commands.Cog):
 		await cfg.channel.set(value)
 		await ctx.send("Update the config entry for address and deleted the old message if found.")
 
+	@ss13mon.command()
+	async def feed_channel(self, ctx: commands.Context, value = None):
+		cfg = self.config.guild(ctx.guild)
+		if(not value == None): value = int(value)
+		await cfg.feed_channel.set(value)
+		await ctx.send("Updated the config entry for the join/leave feed channel.")
+
+	@ss13mon.command()
+	async def sessions(self, ctx: commands.Context, ckey = None):
+		"""
+		Shows how long the currently visible players have been connected
+		"""
+		sessions = self._sessions.get(ctx.guild.id)
+		if(not sessions):
+			await ctx.send("No tracked sessions.")
+			return
+		now = time()
+		if(ckey != None):
+			started = sessions.get(ckey)
+			if(started == None):
+				await ctx.send("`{}` is not currently visible.".format(ckey))
+				return
+			await ctx.send("`{}` has been connected for `{}`.".format(ckey, timedelta(seconds=int(now - started))))
+			return
+		lines = ["{}: {}".format(key, timedelta(seconds=int(now - started))) for key, started in sorted(sessions.items(), key=lambda item: item[1])]
+		for page in utils.chat_formatting.pagify("\n".join(lines)):
+			await ctx.send(utils.chat_formatting.box(page))
+
 	@ss13mon.command()
 	async def update(self, ctx: commands.Context):
 		self.start_guild_update_loop(ctx.guild)
@@ -129,15 +247,15 @@ class SS13Mon(commands.Cog):
 
 		status = await self.query_server(address, port)
 		if(status == None):
-			last_roundid = (await cfg.last_roundid()) or "Unknown"
-			last_title = (await cfg.last_title()) or "Failed to fetch data"
-			last_online = await cfg.last_online() or "Unknown"
+			state = await self.get_state(guild)
+			last_roundid = state["last_roundid"] or "Unknown"
+			last_title = state["last_title"] or "Failed to fetch data"
+			last_online = state["last_online"] or "Unknown"
 			if(isinstance(last_online, float)): last_online = datetime.fromtimestamp(last_online)
 			return discord.Embed(type="rich", color=discord.Colour.red(), title=last_title, timestamp=datetime.utcnow()).add_field(name="Server Offline", value="Last Round: `{}`\nLast Seen: `{}`".format(last_roundid, last_online))
 
 		roundid = int(*status["round_id"])
 		servtitle = str(*status["version"])
-		await self.config.guild(guild).last_roundid.set(roundid)
 		duration = int(*status['round_duration'])
 		duration = str(timedelta(seconds=duration))
 		player_count = int(*status["players"])
@@ -145,12 +263,11 @@ class SS13Mon(commands.Cog):
 		try:
 			players: list[str] = (await self.query_server("localhost", port, "?whoIs"))["players"]
 			players.sort()
+			self.record_player_snapshot(guild, players)
 		except:
 			players = list()
 
-		await cfg.last_roundid.set(roundid)
-		await cfg.last_title.set(servtitle)
-		await cfg.last_online.set(time())
+		await self.set_state(guild, last_roundid=roundid, last_title=servtitle, last_online=time())
 
 		update_interval = await cfg.update_interval()
 		if(update_interval == None):
@@ -167,6 +284,57 @@ class SS13Mon(commands.Cog):
 
 		return embbie
 	
+	def record_player_snapshot(self, guild: discord.Guild, players: 'list[str]'):
+		"""
+		Diffs the visible players against the previous snapshot, queueing joins and leaves for the feed
+		"""
+		current = set(players)
+		previous = self._snapshots.get(guild.id)
+		self._snapshots[guild.id] = current
+		sessions = self._sessions.setdefault(guild.id, dict())
+		now = time()
+		if(previous == None):
+			for ckey in current:
+				sessions.setdefault(ckey, now)
+			return
+
+		joined, left = self._feed_pending.setdefault(guild.id, (list(), list()))
+		for ckey in current - previous:
+			sessions[ckey] = now
+			joined.append(ckey)
+		for ckey in previous - current:
+			started = sessions.pop(ckey, None)
+			left.append((ckey, None if started == None else now - started))
+
+	async def post_player_feed(self, guild: discord.Guild):
+		"""
+		Posts the queued joins and leaves as a single summary, at most once per FEED_BATCH_INTERVAL
+		"""
+		pending = self._feed_pending.get(guild.id)
+		if(pending == None or (not pending[0] and not pending[1])):
+			return
+		if(time() - self._feed_last_post.get(guild.id, 0) < FEED_BATCH_INTERVAL):
+			return
+
+		channel = await self.config.guild(guild).feed_channel()
+		if(channel == None):
+			self._feed_pending.pop(guild.id)
+			return
+		channel: discord.TextChannel = guild.get_channel(channel)
+		if(isinstance(channel, discord.TextChannel) == False):
+			self._feed_pending.pop(guild.id)
+			return
+
+		joined, left = self._feed_pending.pop(guild.id)
+		self._feed_last_post[guild.id] = time()
+		embbie = discord.Embed(type="rich", color=discord.Colour.blue(), title="Player Activity", timestamp=datetime.utcnow())
+		if(joined):
+			embbie.add_field(name="Joined ({})".format(len(joined)), value="```{}```".format(", ".join(sorted(joined))[:1000]), inline=False)
+		if(left):
+			value_left = ", ".join("{} ({})".format(ckey, "?" if duration == None else timedelta(seconds=int(duration))) for ckey, duration in sorted(left))
+			embbie.add_field(name="Left ({})".format(len(left)), value="```{}```".format(value_left[:1000]), inline=False)
+		await channel.send(embed=embbie)
+
 	async def generate_auth_embed(self, guild: discord.Guild):
 		cfg = self.config.guild(guild)
 		address = await cfg.address()
@@ -177,10 +345,10 @@ class SS13Mon(commands.Cog):
 		
 		status = await self.query_server(address, port)
 		if(status == None):
-			last_online = await cfg.last_online_auth() or "Unknown"
+			last_online = (await self.get_state(guild))["last_online_auth"] or "Unknown"
 			if(isinstance(last_online, float)): last_online = datetime.fromtimestamp(last_online)
 			return discord.Embed(type="rich", color=discord.Colour.red(), title="Auth Server", timestamp=datetime.utcnow()).add_field(name="Auth Server Offline", value="Last Seen: `{}`".format(last_online))
-		await cfg.last_online_auth.set(time())
+		await self.set_state(guild, last_online_auth=time())
 
 		public_address = await cfg.public_address()
 		return discord.Embed(type="rich", color=discord.Colour.blue(), title="Auth server", timestamp=datetime.utcnow()).add_field(name="Join", value="<byond://{}:{}/>".format(public_address, port))
@@ -214,7 +382,7 @@ class SS13Mon(commands.Cog):
 		try:
 			local_hash = str(random.random())
 			cfg = self.config.guild(guild)
-			await cfg.update_hash.set(local_hash)
+			self._update_hashes[guild.id] = local_hash
 
 			channel = await cfg.channel()
 			if(channel == None):
@@ -249,8 +417,9 @@ class SS13Mon(commands.Cog):
 					cached_auth = await channel.send("caching initial context")
 					await cfg.message_id_auth.set(cached_auth.id)
 
-			await cached.edit(content=None, embed=(await self.generate_embed(guild)))
-			await cached_auth.edit(content=None, embed=(await self.generate_auth_embed(guild)))
+			await self.edit_if_changed(guild, "status", cached, (await self.generate_embed(guild)))
+			await self.edit_if_changed(guild, "auth", cached_auth, (await self.generate_auth_embed(guild)))
+			await self.post_player_feed(guild)
 
 		except Exception as err:
 			log.error("Encountered an exception when attempting to update guild message: '{}'".format(str(err)))
@@ -259,7 +428,7 @@ class SS13Mon(commands.Cog):
 			return
 
 		await asyncio.sleep(update_interval)
-		actual_hash = await cfg.update_hash()
+		actual_hash = self._update_hashes.get(guild.id)
 		if(actual_hash != local_hash): # command was run again while we were sleeping
 			return
 		
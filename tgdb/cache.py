@@ -0,0 +1,46 @@
+import time
+from collections import OrderedDict
+
+# Returned by TTLCache.get for keys that are not cached, so None can be cached as a value
+MISSING = object()
+
+
+class TTLCache:
+    """
+    Bounded LRU cache whose entries also expire after `ttl` seconds
+    """
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()  # key -> (expiry, value)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return MISSING
+        if entry[0] < time.monotonic():
+            del self.entries[key]
+            return MISSING
+        self.entries.move_to_end(key)
+        return entry[1]
+
+    def set(self, key, value):
+        self.entries[key] = (time.monotonic() + self.ttl, value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.maxsize:
+            self.entries.popitem(last=False)
+
+    def discard(self, key):
+        self.entries.pop(key, None)
+
+    def discard_matching(self, predicate):
+        """
+        Remove every entry for which predicate(key, value) is true
+        """
+        keys = [key for key, (_, value) in self.entries.items() if predicate(key, value)]
+        for key in keys:
+            del self.entries[key]
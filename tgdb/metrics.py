@@ -0,0 +1,76 @@
+import re
+from collections import deque
+
+# Latency samples kept per query template for the percentiles
+LATENCY_SAMPLES = 1024
+
+_WHITESPACE = re.compile(r"\s+")
+_STRING_LITERAL = re.compile(r"'(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"")
+_NUMBER_LITERAL = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?\b")
+_PLACEHOLDER = re.compile(r"%s|%\(\w+\)s")
+_IN_LIST = re.compile(r"\bIN\s*\(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+
+
+def normalize_query(query: str) -> str:
+    """
+    Reduce a query to its template, so the same statement with different values or IN list lengths is counted once
+    """
+    query = _STRING_LITERAL.sub("?", query)
+    query = _PLACEHOLDER.sub("?", query)
+    query = _NUMBER_LITERAL.sub("?", query)
+    query = _IN_LIST.sub("IN (...)", query)
+    return _WHITESPACE.sub(" ", query).strip()
+
+
+class QueryStats:
+    """
+    Counters for a single query template, with the latest `LATENCY_SAMPLES` latencies kept for percentiles
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.rows = 0
+        self.total_time = 0.0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def record(self, elapsed: float, rows: int = 0, error: bool = False):
+        self.count += 1
+        self.total_time += elapsed
+        self.latencies.append(elapsed)
+        if error:
+            self.errors += 1
+        else:
+            self.rows += rows
+
+    def percentile(self, percent: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, max(0, round(percent / 100 * len(ordered)) - 1))
+        return ordered[index]
+
+
+class QueryMetrics:
+    """
+    Per template query statistics
+    """
+
+    def __init__(self):
+        self.stats = {}  # template -> QueryStats
+
+    def record(self, query: str, elapsed: float, rows: int = 0, error: bool = False) -> str:
+        """Record one execution of `query` and return its template"""
+        template = normalize_query(query)
+        stats = self.stats.get(template)
+        if stats is None:
+            stats = self.stats[template] = QueryStats()
+        stats.record(elapsed, rows, error)
+        return template
+
+    def by_total_time(self) -> list:
+        """(template, QueryStats) pairs, the templates the database spent the most time on first"""
+        return sorted(self.stats.items(), key=lambda item: item[1].total_time, reverse=True)
+
+    def reset(self):
+        self.stats.clear()
@@ -1,5 +1,7 @@
 # Standard Imports
+import asyncio
 import logging
+import time
 from typing import Union
 
 # Discord Imports
@@ -19,6 +21,100 @@ log = logging.getLogger("red.oranges_tgverify")
 
 BaseCog = getattr(commands, "Cog", object)
 
+# Members whose links and living minutes are fetched together during a role sweep
+SWEEP_CHUNK_SIZE = 500
+# Seconds between checks for guilds whose scheduled role sweep is due
+SWEEP_CHECK_INTERVAL = 300
+# Seconds between checks for verified members who have reached the living minutes requirement
+PROMOTION_INTERVAL = 900
+# Seconds between role edits made by the role queue, and how long it backs off after Discord rejects one
+ROLE_EDIT_INTERVAL = 0.5
+ROLE_EDIT_BACKOFF = 10
+# Times a role edit Discord rejected is retried before the change is given up on
+ROLE_EDIT_RETRIES = 3
+
+
+class GuildContext:
+    """
+    Stands in for a command context when TGDB is queried from a background job, TGDB only needs the guild
+    """
+
+    def __init__(self, guild):
+        self.guild = guild
+
+
+class RoleQueue:
+    """
+    Applies role changes for one guild, one member at a time, spaced out so large batches stay clear of Discord's rate limits
+    """
+
+    def __init__(self, interval: float = ROLE_EDIT_INTERVAL):
+        self.interval = interval
+        self.queue = asyncio.Queue()
+        self.worker = None
+
+    def put(self, member: discord.Member, add: list, remove: list, reason: str) -> asyncio.Future:
+        """
+        Queue a role change, the returned future resolves to whether every edit was applied
+        """
+        applied = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((member, add, remove, reason, applied))
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self.run())
+        return applied
+
+    def cancel(self):
+        """
+        Stop the worker, changes that were still queued resolve as not applied so nothing waits on them forever
+        """
+        if self.worker is not None:
+            self.worker.cancel()
+        while not self.queue.empty():
+            *_, applied = self.queue.get_nowait()
+            if not applied.done():
+                applied.set_result(False)
+            self.queue.task_done()
+
+    async def run(self):
+        while True:
+            member, add, remove, reason, applied = await self.queue.get()
+            result = False
+            try:
+                result = await self.apply(member, add, remove, reason)
+            except Exception:
+                # One bad change must not stop the worker, or everything queued after it would never be applied
+                log.exception(f"Unexpected error while changing the roles of {member}")
+            finally:
+                if not applied.done():
+                    applied.set_result(result)
+                self.queue.task_done()
+
+    async def apply(self, member: discord.Member, add: list, remove: list, reason: str) -> bool:
+        """
+        Make the role edits for one member, returns False if any of them could not be applied
+        """
+        for roles, edit in ((add, member.add_roles), (remove, member.remove_roles)):
+            if not roles:
+                continue
+            for attempt in range(ROLE_EDIT_RETRIES + 1):
+                try:
+                    await edit(*roles, reason=reason)
+                    break
+                except discord.NotFound:
+                    # The member left while the change was queued
+                    return False
+                except discord.Forbidden:
+                    log.warning(f"Missing permissions to change roles of {member} in {member.guild}")
+                    return False
+                except discord.HTTPException as err:
+                    if attempt == ROLE_EDIT_RETRIES:
+                        log.warning(f"Discord rejected a role change for {member}, giving up: {err}")
+                        return False
+                    log.warning(f"Discord rejected a role change for {member}, backing off: {err}")
+                    await asyncio.sleep(ROLE_EDIT_BACKOFF)
+            await asyncio.sleep(self.interval)
+        return True
+
 
 class TGverify(BaseCog):
     """
@@ -39,6 +135,8 @@ class TGverify(BaseCog):
             "bunkerwarning",
             "bunker",
             "welcomechannel",
+            "sweep_interval",
+            "auto_promote",
         ]
 
         default_guild = {
@@ -52,9 +150,31 @@ class TGverify(BaseCog):
             "bunker": False,
             "disabled": False,
             "welcomechannel": "",
+            # Hours between automatic role sweeps, 0 disables them
+            "sweep_interval": 0,
+            # Id of the last member a sweep finished with, so an interrupted sweep can resume
+            "sweep_cursor": 0,
+            "last_sweep": 0,
+            "auto_promote": False,
         }
 
         self.config.register_guild(**default_guild)
+        # guild id -> RoleQueue
+        self.role_queues = {}
+        self.sweep_locks = {}
+        self.sweep_task = None
+        self.promotion_task = None
+
+    async def cog_load(self):
+        self.sweep_task = asyncio.create_task(self.sweep_loop())
+        self.promotion_task = asyncio.create_task(self.promotion_loop())
+
+    async def cog_unload(self):
+        for task in (self.sweep_task, self.promotion_task):
+            if task is not None:
+                task.cancel()
+        for queue in self.role_queues.values():
+            queue.cancel()
 
     @commands.guild_only()
     @commands.hybrid_group()
@@ -221,6 +341,33 @@ class TGverify(BaseCog):
         except (ValueError, KeyError, AttributeError):
             await ctx.send("There was a problem toggling the disabled flag")
 
+    @config.command()
+    async def sweep_interval(self, ctx, hours: int = 0):
+        """
+        Sets how many hours apart the verified roles of all members are automatically reconciled
+
+        Leave blank or set to 0 to disable the automatic sweep
+        """
+        if hours < 0:
+            return await ctx.send("The sweep interval can't be negative")
+        await self.config.guild(ctx.guild).sweep_interval.set(hours)
+        if hours:
+            await ctx.send(f"Verified roles will be reconciled every `{hours}` hours")
+        else:
+            await ctx.send("Automatic role sweeps disabled")
+
+    @config.command()
+    async def auto_promote(self, ctx):
+        """
+        Toggle automatically granting the living minutes role to verified users once they have enough living minutes
+        """
+        auto_promote = not await self.config.guild(ctx.guild).auto_promote()
+        await self.config.guild(ctx.guild).auto_promote.set(auto_promote)
+        if auto_promote:
+            await ctx.send("Verified users will now be promoted automatically once they have enough living minutes")
+        else:
+            await ctx.send("Automatic promotion disabled")
+
     @config.command()
     async def verified_role(self, ctx, verified_role: int = None):
         """
@@ -265,6 +412,37 @@ class TGverify(BaseCog):
         except (ValueError, KeyError, AttributeError):
             await ctx.send("There was a problem setting the verified role")
 
+    @tgverify.command()
+    @checks.is_owner()
+    async def sweep(self, ctx, restart: bool = False, dry_run: bool = False):
+        """
+        Reconcile the verified roles of every member against their discord links and living minutes
+
+        An interrupted sweep resumes where it stopped unless restart is set, dry_run only reports what would change
+        """
+        lock = self.sweep_locks.setdefault(ctx.guild.id, asyncio.Lock())
+        if lock.locked():
+            return await ctx.send("A role sweep is already running for this discord")
+        message = await ctx.send("Starting role sweep....")
+
+        async def progress(done, total, added, removed, failed):
+            if dry_run:
+                content = f"Checked {done}/{total} members, {added} roles to add and {removed} to remove so far...."
+            else:
+                content = f"Swept {done}/{total} members, {added} roles added, {removed} removed and {failed} members failed so far...."
+            await message.edit(content=content)
+
+        async with lock:
+            done, added, removed, failed = await self.reconcile_roles(ctx.guild, restart, dry_run, progress)
+        if dry_run:
+            return await message.edit(
+                content=f"Dry run complete, {done} members checked, {added} roles would be added and {removed} removed"
+            )
+        content = f"Role sweep complete, {done} members checked, {added} roles added and {removed} removed"
+        if failed:
+            content += f". The roles of {failed} members could not be changed, see the log for details"
+        await message.edit(content=content)
+
     @tgverify.command()
     async def discords(self, ctx, ckey: str):
         """
@@ -451,12 +629,11 @@ class TGverify(BaseCog):
 
         if not prexisting:
             # clear any/all previous valid links for ckey or the discord id (in case they have decided to make a new ckey)
-            await tgdb.clear_all_valid_discord_links_for_ckey(ctx, ckey)
-            await tgdb.clear_all_valid_discord_links_for_discord_id(
-                ctx, ctx.author.id
-            )
-            # Record that the user is linked against a discord id
-            await tgdb.update_discord_link(ctx, one_time_token, ctx.author.id)
+            # and record that the user is linked against a discord id, all in one transaction
+            if not await tgdb.verify_discord_link(ctx, ckey, one_time_token, ctx.author.id):
+                raise TGRecoverableError(
+                    f"Sorry {ctx.author} that one time token has already been used or has expired, go back into game and try generating another! See {instructions_link} for more information."
+                )
 
         successful = False
         if role:
@@ -545,12 +722,11 @@ class TGverify(BaseCog):
 
         if not prexisting:
             # clear any/all previous valid links for ckey or the discord id (in case they have decided to make a new ckey)
-            await tgdb.clear_all_valid_discord_links_for_ckey(interaction, ckey)
-            await tgdb.clear_all_valid_discord_links_for_discord_id(
-                interaction, interaction.user.id
-            )
-            # Record that the user is linked against a discord id
-            await tgdb.update_discord_link(interaction, one_time_token, interaction.user.id)
+            # and record that the user is linked against a discord id, all in one transaction
+            if not await tgdb.verify_discord_link(interaction, ckey, one_time_token, interaction.user.id):
+                return await interaction.edit_original_response(
+                    content=f"Sorry {interaction.user.name} that one time token has already been used or has expired, go back into game and try generating another! See {instructions_link} for more information."
+                )
 
         successful = False
         if role:
@@ -615,6 +791,164 @@ class TGverify(BaseCog):
 
         await channel.send(final)
 
+    def get_role_queue(self, guild) -> RoleQueue:
+        queue = self.role_queues.get(guild.id)
+        if queue is None:
+            queue = self.role_queues[guild.id] = RoleQueue()
+        return queue
+
+    async def reconcile_roles(self, guild, restart: bool = False, dry_run: bool = False, progress=None):
+        """
+        Walk the guild's members in chunks, batch fetching their discord links and living minutes, and queue the
+        role additions and removals needed for each member's roles to match their verification
+
+        Members are walked in id order and the cursor is saved after every chunk, so an interrupted sweep resumes
+        where it stopped. Returns the number of members checked, of roles added and removed, and of members whose
+        changes could not be applied
+        """
+        settings = await self.config.guild(guild).all()
+        role = guild.get_role(settings["verified_role"])
+        living_role = guild.get_role(settings["verified_living_role"])
+        if not role or not living_role:
+            raise TGUnrecoverableError(
+                "Both verification roles need to be configured before roles can be swept, configure them with the config command"
+            )
+        tgdb = self.get_tgdb()
+        context = GuildContext(guild)
+        queue = self.get_role_queue(guild)
+
+        if not guild.chunked:
+            await guild.chunk()
+        cursor = 0 if restart or dry_run else settings["sweep_cursor"]
+        members = sorted((member for member in guild.members if not member.bot and member.id > cursor), key=lambda m: m.id)
+        done = added = removed = failed = 0
+        for i in range(0, len(members), SWEEP_CHUNK_SIZE):
+            chunk = members[i : i + SWEEP_CHUNK_SIZE]
+            changes = []
+            links = await tgdb.discord_links_for_discord_ids(context, [member.id for member in chunk])
+            links = {discord_id: link for discord_id, link in links.items() if link.valid}
+            players = await tgdb.get_players_by_ckeys(context, [link.ckey for link in links.values()])
+            # The database matches ckeys case insensitively, so the returned keys may differ in case
+            living_minutes = {ckey.lower(): player["living_time"] for ckey, player in players.items()}
+
+            for member in chunk:
+                desired = set()
+                link = links.get(member.id)
+                if link:
+                    desired.add(role)
+                    if living_minutes.get(link.ckey.lower(), 0) >= settings["min_living_minutes"]:
+                        desired.add(living_role)
+                current = {r for r in (role, living_role) if r in member.roles}
+                add = list(desired - current)
+                remove = list(current - desired)
+                if not add and not remove:
+                    continue
+                if dry_run:
+                    added += len(add)
+                    removed += len(remove)
+                else:
+                    changes.append((queue.put(member, add, remove, "Verified role sweep"), add, remove))
+
+            done += len(chunk)
+            if not dry_run:
+                # Only this sweep's changes are waited on, verify and promotion edits share the queue
+                results = await asyncio.gather(*(applied for applied, _, _ in changes))
+                for applied, (_, add, remove) in zip(results, changes):
+                    if applied:
+                        added += len(add)
+                        removed += len(remove)
+                    else:
+                        failed += 1
+                await self.config.guild(guild).sweep_cursor.set(chunk[-1].id)
+            if progress:
+                await progress(done, len(members), added, removed, failed)
+
+        if not dry_run:
+            await self.config.guild(guild).sweep_cursor.set(0)
+            await self.config.guild(guild).last_sweep.set(time.time())
+        return done, added, removed, failed
+
+    async def sweep_loop(self):
+        """
+        Run the scheduled role sweep of every guild that has one enabled, once its interval has passed
+        """
+        await self.bot.wait_until_red_ready()
+        while True:
+            for guild_id, settings in (await self.config.all_guilds()).items():
+                if not settings["sweep_interval"]:
+                    continue
+                if time.time() - settings["last_sweep"] < settings["sweep_interval"] * 3600:
+                    continue
+                guild = self.bot.get_guild(guild_id)
+                lock = self.sweep_locks.setdefault(guild_id, asyncio.Lock())
+                if guild is None or lock.locked():
+                    continue
+                try:
+                    async with lock:
+                        done, added, removed, failed = await self.reconcile_roles(guild)
+                    log.info(
+                        f"Role sweep of {guild} checked {done} members, added {added} roles and removed {removed}, "
+                        f"{failed} members failed"
+                    )
+                except (TGRecoverableError, TGUnrecoverableError, discord.DiscordException) as err:
+                    log.warning(f"Scheduled role sweep of {guild} failed: {err}")
+                except Exception:
+                    log.exception(f"Scheduled role sweep of {guild} failed")
+            await asyncio.sleep(SWEEP_CHECK_INTERVAL)
+
+    async def promote_verified_members(self, guild):
+        """
+        Grant the living minutes role to every member with the verified role who now has enough living minutes
+
+        Candidates are picked from the member cache and checked against the database in one set based query.
+        Returns how many members were promoted, and how many qualified but could not be given the role
+        """
+        settings = await self.config.guild(guild).all()
+        role = guild.get_role(settings["verified_role"])
+        living_role = guild.get_role(settings["verified_living_role"])
+        if not role or not living_role:
+            return 0, 0
+        if not guild.chunked:
+            await guild.chunk()
+        candidates = [m.id for m in guild.members if not m.bot and role in m.roles and living_role not in m.roles]
+        if not candidates:
+            return 0, 0
+        tgdb = self.get_tgdb()
+        living = await tgdb.discord_ids_with_living_minutes(
+            GuildContext(guild), candidates, settings["min_living_minutes"]
+        )
+        queue = self.get_role_queue(guild)
+        changes = []
+        for discord_id in living:
+            member = guild.get_member(discord_id)
+            if member:
+                changes.append(queue.put(member, [living_role], [], "User has reached the required living minutes"))
+        results = await asyncio.gather(*changes)
+        promoted = sum(results)
+        return promoted, len(results) - promoted
+
+    async def promotion_loop(self):
+        """
+        Periodically promote verified members of every guild with automatic promotion enabled
+        """
+        await self.bot.wait_until_red_ready()
+        while True:
+            for guild_id, settings in (await self.config.all_guilds()).items():
+                guild = self.bot.get_guild(guild_id)
+                if not settings["auto_promote"] or guild is None:
+                    continue
+                try:
+                    promoted, failed = await self.promote_verified_members(guild)
+                    if promoted:
+                        log.info(f"Promoted {promoted} verified members of {guild}")
+                    if failed:
+                        log.warning(f"Could not promote {failed} verified members of {guild}, see above for details")
+                except (TGRecoverableError, TGUnrecoverableError, discord.DiscordException) as err:
+                    log.warning(f"Automatic promotion for {guild} failed: {err}")
+                except Exception:
+                    log.exception(f"Automatic promotion for {guild} failed")
+            await asyncio.sleep(PROMOTION_INTERVAL)
+
     def get_tgdb(self):
         tgdb = self.bot.get_cog("TGDB")
         if not tgdb: